@@ -1,32 +1,47 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
 import functools
 from hashlib import sha256
 import hmac
-import json
+import logging
+from operator import itemgetter
 import os
+import random
 import sys
+import threading
 import time
 
 import click
-import requests
+import orjson
 
 sys.path.append(os.path.dirname(__file__))
-from util import get_graph, write_graph, write_users
+from util import (get_graph, http_session, make_node, write_graph,
+                  write_users, MAX_WORKERS, OutputFile, POOL_SIZE)
 
 
 API_URL = 'https://api.instagram.com/v1'
+CACHE_PATH = '.instagram_cache.sqlite'
+
+# Initial and maximum delay (in seconds) for the exponential backoff used when
+# a rate-limited response does not say when the limit resets.
+RETRY_MIN = 30
+RETRY_MAX = 300
+
+# Extracts the (ID, username) pair from a user record in an API response.
+USER_FIELDS = itemgetter('id', 'username')
 
 
 class Config(object):
     ''' Keeps track of configuration. '''
 
     def __init__(self):
-        self.api_url = API_URL
+        self.api_url = API_URL.rstrip('/')
         self.client_id = None
         self.client_secret = None
         self.debug = False
+        self.hmac = None
+        self.http = None
+        self.stop = threading.Event()
 
 
 pass_config = click.make_pass_decorator(Config, ensure=True)
@@ -39,12 +54,23 @@ pass_config = click.make_pass_decorator(Config, ensure=True)
 @click.option('--client-secret',
               envvar='INSTAGRAM_CLIENT_SECRET',
               help='Your client secret (required, or export INSTAGRAM_CLIENT_SECRET)')
+@click.option('--cache/--no-cache',
+              default=True,
+              help='Cache successful responses for a day in {} (default: ' \
+                   'cache)'.format(CACHE_PATH))
 @pass_config
-def cli(config, client_id, client_secret):
+def cli(config, client_id, client_secret, cache):
     if client_id is None:
         raise click.ClickException('Client ID is required.')
+    if client_secret is None:
+        raise click.ClickException('Client secret is required.')
     config.client_id = client_id
     config.client_secret = client_secret
+    config.http = http_session(CACHE_PATH if cache else None)
+
+    # The key is fixed for the whole run, so key the HMAC once and copy it for
+    # each request signature.
+    config.hmac = hmac.new(key=client_secret.encode('utf8'), digestmod=sha256)
 
 
 @cli.command('id')
@@ -92,39 +118,49 @@ def info(config, user_id):
 @click.option('--depth',
               type=float,
               default=1,
-              help='Maximum number of hops from the seed user.')
+              help='Maximum number of hops from the seed users.')
 @click.option('--max-follow',
               default=100,
               help='Maximum number of followers or followees to traverse per user.')
-@click.argument('user_id')
-@click.argument('username_file', type=click.File('w', lazy=False))
-@click.argument('graph_file', type=click.File('w', lazy=False))
+@click.option('--workers',
+              type=click.IntRange(1, POOL_SIZE),
+              default=MAX_WORKERS,
+              help='Number of users to fetch concurrently.')
+@click.argument('user_ids', nargs=-1, required=True)
+@click.argument('username_file', type=OutputFile())
+@click.argument('graph_file', type=OutputFile())
 @pass_config
-def graph(config, user_id, depth, max_follow, username_file, graph_file):
+def graph(config, user_ids, depth, max_follow, workers, username_file,
+          graph_file):
     '''
     Get follower/following graph.
 
-    Starting with the seed user identified by USER_ID, construct a directed
+    Starting with the seed users identified by USER_IDS, construct a directed
     follower/following graph by traversing up to --depth hops (default: 1).
     For each user, fetch only --max-follow followers and followees.
+
+    All seeds are traversed together, so users reachable from more than one
+    seed are only fetched once.
     '''
 
-    # Get username for this user_id.
-    endpoint = '/users/{}'.format(user_id)
-    response = _get_instagram(config, endpoint)
+    # Get usernames for the seed user_ids.
+    seeds = dict()
 
-    if response.status_code != 200:
-        raise click.ClickException(
-            'Unable to fetch user information: {} {}'
-            .format(response.status_code, response.payload['meta']['error_message'])
-        )
+    for user_id in user_ids:
+        endpoint = '/users/{}'.format(user_id)
+        response = _get_instagram(config, endpoint)
 
-    user_info = json.loads(response.text)
-    username = user_info['data']['username']
+        if response.status_code != 200:
+            raise click.ClickException(
+                'Unable to fetch user information: {} {}'
+                .format(response.status_code, response.payload['meta']['error_message'])
+            )
+
+        seeds[user_id] = response.payload['data']['username']
 
     # Get graph.
     node_fn = functools.partial(_get_graph, config, max_follow)
-    users, graph = get_graph(node_fn, {user_id: username}, depth)
+    users, graph = get_graph(node_fn, seeds, depth, workers, stop=config.stop)
 
     write_users(users, username_file)
     write_graph(graph, graph_file)
@@ -132,33 +168,53 @@ def graph(config, user_id, depth, max_follow, username_file, graph_file):
     click.secho('Finished: {} nodes'.format(len(users)))
 
 
-def _get_instagram(config, endpoint, params={}):
-    ''' Get a resource from instagram. '''
+def _get_instagram(config, endpoint, params=None):
+    '''
+    Get a resource from instagram.
 
-    signature = hmac.new(
-        key=config.client_secret.encode('utf8'),
-        msg=endpoint.encode('utf8'),
-        digestmod=sha256
-    )
+    `endpoint` is the resource's path under the API URL, including the leading
+    slash.
 
-    params['client_id'] = config.client_id
+    This is called concurrently while extracting a graph, so it must not share
+    mutable state between calls.
+    '''
 
-    for key in sorted(params.keys()):
-        signature.update('|{}={}'.format(key, params[key]).encode('utf8'))
+    if params is None:
+        params = {}
 
+    params['client_id'] = config.client_id
+
+    # Sign the endpoint followed by the sorted parameters, hashed as a single
+    # message rather than one small update per parameter.
+    message = endpoint + ''.join(
+        '|{}={}'.format(key, value) for key, value in sorted(params.items())
+    )
+    signature = config.hmac.copy()
+    signature.update(message.encode('utf8'))
     params['sig'] = signature.hexdigest()
-    url = '{}/{}'.format(config.api_url, endpoint.lstrip('/'))
+    url = config.api_url + endpoint
     click.echo('Requesting: {}'.format(url))
-    response = requests.get(url, params=params)
+    response = config.http.get(url, params=params)
+
+    attempt = 0
 
     while response.status_code == 429:
-        err = 'Error: over the rate limit! (Will try again in 5 minutes.)'
+        delay = _retry_delay(response, attempt)
+        err = 'Error: over the rate limit! (Will try again in {:.0f} seconds.)' \
+              .format(delay)
         click.secho(err, fg='red')
-        time.sleep(300)
+
+        # Wait on the stop event rather than sleeping, so that a fetch thread
+        # gives up as soon as the graph extraction ends.
+        if config.stop.wait(delay):
+            raise click.ClickException('Stopped while waiting to retry: {}'
+                                       .format(url))
+
+        attempt += 1
         click.echo('Requesting (again): {}'.format(url))
-        response = requests.get(url, params=params)
+        response = config.http.get(url, params=params)
 
-    response.payload = response.json()
+    response.payload = orjson.loads(response.content)
     response.rate_limit = int(response.headers['X-Ratelimit-Remaining'])
 
     if response.rate_limit <= 5:
@@ -168,23 +224,38 @@ def _get_instagram(config, endpoint, params={}):
     return response
 
 
+def _retry_delay(response, attempt):
+    '''
+    Return the number of seconds to wait before retrying a rate-limited
+    request.
+
+    If the API says when the rate limit resets, wait until then. Otherwise, or
+    if that time has already passed, back off exponentially, with jitter so
+    that concurrent requests don't all retry at the same moment.
+    '''
+
+    reset = response.headers.get('X-Ratelimit-Reset')
+
+    if reset is not None:
+        delay = float(reset) - time.time()
+
+        if delay > 0:
+            return max(1, delay)
+
+    delay = min(RETRY_MAX, RETRY_MIN * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
 def _get_graph(config, max_follow, user_id, user_name):
     ''' Helper function for getting social graph. '''
 
-    users = dict()
-    graph = defaultdict(set)
-
     # Get follows.
     endpoint = '/users/{}/follows'.format(user_id)
     response = _get_instagram(config, endpoint, {'count': max_follow})
+    follows = []
 
     if response.status_code == 200:
-        for user in response.payload['data']:
-            following_id = user['id']
-            following_name = user['username']
-
-            users[following_id] = following_name
-            graph[user_id].add(following_id)
+        follows = list(map(USER_FIELDS, response.payload['data']))
     else:
         warn = 'Warning: unable to fetch follows: {} {}'.format(
             response.status_code,
@@ -195,14 +266,10 @@ def _get_graph(config, max_follow, user_id, user_name):
     # Get followers.
     endpoint = '/users/{}/followed-by'.format(user_id)
     response = _get_instagram(config, endpoint, {'count': max_follow})
+    followers = []
 
     if response.status_code == 200:
-        for user in response.payload['data']:
-            followed_id = user['id']
-            followed_name = user['username']
-
-            users[followed_id] = followed_name
-            graph[followed_id].add(user_id)
+        followers = list(map(USER_FIELDS, response.payload['data']))
     else:
         warn = 'Warning: unable to fetch followed-by: {} {}'.format(
             response.status_code,
@@ -210,8 +277,10 @@ def _get_graph(config, max_follow, user_id, user_name):
         )
         click.secho(warn, fg='yellow')
 
-    return users, graph
+    return make_node(user_id, follows, followers)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.INFO,
+                        stream=sys.stdout)
     cli()
@@ -1,7 +1,9 @@
 from collections import defaultdict
 import functools
+import io
 import os
 import sys
+import threading
 import unittest
 
 sys.path.append(os.path.dirname(__file__))
@@ -53,6 +55,37 @@ class TestSqlToJl(unittest.TestCase):
 
         return users, graph
 
+    def _interrupting_node_fn(self, depth, merges):
+        '''
+        Wrap `_generate_node()` so that the crawl is interrupted when it merges
+        the graph of the `merges`th node that it fetched at hop `depth`.
+
+        The interrupt is raised by the thread merging the results, just like a
+        real Ctrl-C, so it doesn't depend on which fetches finish first.
+        '''
+
+        merged = []
+
+        class InterruptingGraph(defaultdict):
+            def items(self):
+                merged.append(self)
+
+                if len(merged) == merges:
+                    raise KeyboardInterrupt()
+
+                return super().items()
+
+        def node_fn(user_id, user_name):
+            users, graph = self._generate_node(user_id, user_name)
+
+            # Node IDs get one digit longer with each hop.
+            if len(user_id) == depth:
+                graph = InterruptingGraph(set, graph)
+
+            return users, graph
+
+        return node_fn
+
     def test_get_graph_depth_1(self):
         ''' Test graph generation at depth 1. '''
 
@@ -156,6 +189,200 @@ class TestSqlToJl(unittest.TestCase):
         # and test_get_graph_depth_2().
         self.assertIn('101', graph['100'])
 
+    def test_get_graph_fetches_each_node_once(self):
+        ''' Test that nodes reachable from several frontiers are fetched once. '''
+
+        fetched = []
+
+        def node_fn(user_id, user_name):
+            # Nodes 0-5 form a ring where each node follows and is followed by
+            # both of its neighbors, so most nodes are reached from two sides.
+            fetched.append(user_id)
+            users = {}
+            graph = defaultdict(set)
+
+            for offset in (-1, 1):
+                friend_id = str((int(user_id) + offset) % 6)
+                users[friend_id] = 'user{}'.format(friend_id)
+                graph[user_id].add(friend_id)
+                graph[friend_id].add(user_id)
+
+            return users, graph
+
+        users, graph = util.get_graph(node_fn, seeds={'0': 'user0'}, max_depth=4)
+
+        self.assertEqual(6, len(users))
+        self.assertEqual(12, self._count_edges(graph))
+        self.assertEqual(['0', '1', '2', '3', '4', '5'], sorted(fetched))
+
+    def test_get_graph_fetches_hop_concurrently(self):
+        ''' Test that the nodes in a hop are fetched at the same time. '''
+
+        # Each of the 4 nodes in the second hop waits until all of them have
+        # started, which only succeeds if they are fetched concurrently.
+        barrier = threading.Barrier(4, timeout=5)
+
+        def node_fn(user_id, user_name):
+            if user_id != '1':
+                barrier.wait()
+
+            return self._generate_node(user_id, user_name)
+
+        users, graph = util.get_graph(node_fn, seeds={'1': 'user1'}, max_depth=2)
+
+        # Same graph as test_get_graph_depth_2().
+        self.assertEqual(21, len(users))
+        self.assertEqual(21, self._count_edges(graph))
+
+    def test_get_graph_interrupted(self):
+        ''' Test that an interrupted crawl only has edges between its users. '''
+
+        # Interrupt the second of three hops while merging its second node,
+        # whatever order the nodes finish in.
+        node_fn = self._interrupting_node_fn(depth=2, merges=2)
+        users, graph = util.get_graph(node_fn, seeds={'1': 'user1'}, max_depth=3)
+
+        # 1 seed node, 4 nodes within one hop, and 4 neighbors each for the two
+        # nodes that were fetched in the second hop.
+        self.assertEqual(13, len(users))
+
+        for follower, follows in graph.items():
+            self.assertIn(follower, users)
+            self.assertLessEqual(follows, users.keys())
+
+    def test_get_graph_sets_stop(self):
+        ''' Test that the stop event is set once the crawl ends. '''
+
+        stop = threading.Event()
+        util.get_graph(self._generate_node, seeds={'1': 'user1'}, max_depth=1,
+                       stop=stop)
+
+        self.assertTrue(stop.is_set())
+
+    def test_get_graph_skips_visited(self):
+        ''' Test that nodes fetched by an earlier crawl are not fetched again. '''
+
+        fetched = []
+
+        def node_fn(user_id, user_name):
+            fetched.append(user_id)
+            return self._generate_node(user_id, user_name)
+
+        visited = {'10', '12'}
+        users, graph = util.get_graph(node_fn, seeds={'1': 'user1'}, max_depth=2,
+                                      visited=visited)
+
+        # Nodes 10 and 12 are still in the graph, but only as neighbors of 1.
+        self.assertEqual(['1', '11', '13'], sorted(fetched))
+        self.assertEqual(13, len(users))
+        self.assertEqual({'10', '11'}, graph['1'])
+        self.assertEqual({'1', '10', '11', '12', '13'}, visited)
+
+    def test_get_graphs(self):
+        ''' Test extracting several independent graphs at once. '''
+
+        results = util.get_graphs(self._generate_node,
+                                  seed_batches=[{'1': 'user1'}, {'2': 'user2'}],
+                                  max_depth=1.5)
+
+        self.assertEqual(2, len(results))
+
+        # Each graph matches test_get_graph_depth_1_5() for its own seed.
+        for seed, (users, graph) in zip(('1', '2'), results):
+            self.assertEqual(5, len(users))
+            self.assertEqual(5, self._count_edges(graph))
+            self.assertEqual({seed + '0', seed + '1'}, graph[seed])
+            self.assertIn(seed + '1', graph[seed + '0'])
+
+    def test_get_graphs_interrupted(self):
+        ''' Test that an interrupt keeps every crawl's results so far. '''
+
+        # Interrupt the second of three hops while merging the last of the
+        # eight nodes that the two crawls fetch in it.
+        node_fn = self._interrupting_node_fn(depth=2, merges=8)
+        results = util.get_graphs(node_fn,
+                                  seed_batches=[{'1': 'user1'}, {'2': 'user2'}],
+                                  max_depth=3)
+
+        self.assertEqual(2, len(results))
+
+        # Both crawls keep all of their users from the first two hops (as in
+        # test_get_graph_depth_2()), and only edges between them.
+        for users, graph in results:
+            self.assertEqual(21, len(users))
+
+            for follower, follows in graph.items():
+                self.assertIn(follower, users)
+                self.assertLessEqual(follows, users.keys())
+
+    def test_make_node(self):
+        ''' Test building a node's users and graph from its relations. '''
+
+        users, graph = util.make_node(
+            '1',
+            following=[('2', 'bob'), ('1', 'alice')],
+            followers=[('1', 'alice'), ('3', 'eve')]
+        )
+
+        self.assertEqual({'1': 'alice', '2': 'bob', '3': 'eve'}, users)
+
+        # Node 1 follows itself, so it has both a follower and a followee
+        # entry, and neither may replace the other.
+        self.assertEqual({'1', '2'}, graph['1'])
+        self.assertEqual({'1'}, graph['3'])
+        self.assertEqual(3, self._count_edges(graph))
+
+    def test_make_node_interns_ids(self):
+        ''' Test that node IDs are interned. '''
+
+        # Build the IDs at runtime so that they aren't interned constants.
+        user_id, friend_id = ''.join(['user', '1']), ''.join(['user', '2'])
+        users, graph = util.make_node(user_id, [(friend_id, 'bob')], [])
+
+        self.assertIs(sys.intern('user2'), next(iter(users)))
+        self.assertIs(sys.intern('user2'), next(iter(graph['user1'])))
+        self.assertIs(sys.intern('user1'), next(iter(graph)))
+
+    def test_merge_graphs(self):
+        ''' Test merging one graph into another. '''
+
+        source = {'1': {'2', '3'}, '4': {'1'}}
+        dest = defaultdict(set)
+        dest['1'] |= {'3', '5'}
+
+        util.merge_graphs(source, dest)
+
+        self.assertEqual({'2', '3', '5'}, dest['1'])
+        self.assertEqual({'1'}, dest['4'])
+
+        # Followers that were new to `dest` take the source's set as is.
+        self.assertIs(source['4'], dest['4'])
+
+    def test_write_graph(self):
+        ''' Test writing a graph as a tab-separated adjacency list. '''
+
+        graph = defaultdict(set)
+        graph['1'] |= {'2', '3'}
+        graph['2'] |= {'3'}
+        graph['4'] = set()
+        file_ = io.StringIO()
+
+        util.write_graph(graph, file_)
+
+        lines = file_.getvalue().split('\n')
+        self.assertEqual('', lines.pop())
+        self.assertEqual(['1\t2', '1\t3', '2\t3'], sorted(lines))
+
+    def test_write_users(self):
+        ''' Test writing a tab-separated mapping of user IDs to usernames. '''
+
+        users = {'1': 'alice', '2': 'bob'}
+        file_ = io.StringIO()
+
+        util.write_users(users, file_)
+
+        self.assertEqual('1\talice\n2\tbob\n', file_.getvalue())
+
 
 if __name__ == '__main__':
     unittest.main(buffer=True)
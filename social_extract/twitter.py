@@ -1,22 +1,35 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import functools
-import json
+import logging
 import os
-import pickle
 import sys
+import threading
 
-import bs4
 import click
-import requests
+import orjson
+from selectolax.lexbor import LexborHTMLParser
 
 sys.path.append(os.path.dirname(__file__))
-from util import get_graph, write_graph, write_users
+from util import (get_graph, http_session, make_node, write_graph,
+                  write_users, MAX_WORKERS, OutputFile, POOL_SIZE)
 
 
 TWITTER_URL = 'https://twitter.com/'
 
+# CSS selectors for the scraped parts of Twitter's pages.
+CSRF_SELECTOR = 'input[name=authenticity_token]'
+HOME_USER_SELECTOR = '.ProfileNav-item--userActions .user-actions'
+PAGE_USERS_SELECTOR = '.user-actions'
+PROFILE_CARD_SELECTOR = '.ProfileCard-content'
+PROFILE_CARD_USER_SELECTOR = '.user-actions'
+TIMELINE_SELECTOR = '.GridTimeline-items'
+
+# Cookie attributes saved in the session file, so that restored cookies are
+# only sent to the same hosts, paths and schemes as before.
+COOKIE_FIELDS = ('name', 'value', 'domain', 'path', 'secure', 'expires')
+
 
 class Config(object):
     ''' Keeps track of configuration. '''
@@ -25,6 +38,7 @@ class Config(object):
         self.debug = False
         self.password = None
         self.session = None
+        self.stop = threading.Event()
         self.twitter_url = TWITTER_URL.rstrip('/')
         self.user = None
 
@@ -60,36 +74,38 @@ def cli(config, user, password, url, session):
 @click.option('--depth',
               type=float,
               default=1,
-              help='Maximum number of hops from the seed user.')
+              help='Maximum number of hops from the seed users.')
 @click.option('--max-follow',
               default=100,
               help='Maximum number of followers or followees to traverse per ' \
                    'user. (May exceed this size a bit because it breaks on ' \
                    'page boundaries.)')
-@click.argument('username')
-@click.argument('username_file', type=click.File('w', lazy=False))
-@click.argument('graph_file', type=click.File('w', lazy=False))
+@click.option('--workers',
+              type=click.IntRange(1, POOL_SIZE // 2),
+              default=MAX_WORKERS,
+              help='Number of users to fetch concurrently. (Each user\'s ' \
+                   'following and followers are fetched in parallel, so ' \
+                   'this makes twice as many concurrent requests.)')
+@click.argument('usernames', nargs=-1, required=True)
+@click.argument('username_file', type=OutputFile())
+@click.argument('graph_file', type=OutputFile())
 @pass_config
-def graph(config, depth, max_follow, username, username_file, graph_file):
-    ''' Get a twitter user's friends/follower graph. '''
-
-    session = _login_twitter(config)
-
-    # Get user ID.
-    home_url = '{}/{}'.format(config.twitter_url, username)
-    response = session.get(home_url)
+def graph(config, depth, max_follow, workers, usernames, username_file,
+          graph_file):
+    '''
+    Get twitter users' friends/follower graph.
 
-    if response.status_code != 200:
-        raise click.ClickException('Not able to get home page for {}. ({})'
-                                   .format(username, response.status_code))
+    All of the seed USERNAMES are traversed together, so users reachable from
+    more than one seed are only fetched once.
+    '''
 
-    html = bs4.BeautifulSoup(response.text, 'html.parser')
-    profile_el = html.select('.ProfileNav-item--userActions .user-actions')[0]
-    user_id = profile_el['data-user-id']
+    session = _login_twitter(config)
+    seeds = {_get_user_id(session, config, username): username
+             for username in usernames}
 
     # Get graph.
     node_fn = functools.partial(_get_graph, session, config, max_follow)
-    users, graph = get_graph(node_fn, {user_id: username}, depth)
+    users, graph = get_graph(node_fn, seeds, depth, workers, stop=config.stop)
 
     write_users(users, username_file)
     write_graph(graph, graph_file)
@@ -104,17 +120,7 @@ def id_(config, username):
     ''' Get a twitter user ID for USERNAME. '''
 
     session = _login_twitter(config)
-
-    home_url = '{}/{}'.format(config.twitter_url, username)
-    response = session.get(home_url)
-
-    if response.status_code != 200:
-        raise click.ClickException('Not able to get home page for {}. ({})'
-                                   .format(username, response.status_code))
-
-    html = bs4.BeautifulSoup(response.text, 'html.parser')
-    profile_el = html.select('.ProfileNav-item--userActions .user-actions')[0]
-    user_id = profile_el['data-user-id']
+    user_id = _get_user_id(session, config, username)
 
     click.secho('{} has ID {}'.format(username, user_id))
 
@@ -123,124 +129,77 @@ def _get_graph(session, config, max_follow, user_id, username):
     '''
     Fetch friends (a.k.a. "following") and followers.
 
+    The two lists are paginated independently, so they are walked
+    concurrently.
+
     Returns a tuple:
 
         0. dictionary mapping ID to username
         1. dictionary mapping each ID to its `set` of followers
     '''
 
-    users = dict()
-    graph = defaultdict(set)
-
-    # Fetch first page of friends.
-    following_url = '{}/{}/following'.format(config.twitter_url, username)
-    click.echo('Getting {}'.format(following_url))
-    response = session.get(following_url)
-
-    if response.status_code != 200:
-        click.secho('Not able to fetch friends: ()'.format(response.status_code))
-
-    html = bs4.BeautifulSoup(response.text, 'html.parser')
-
-    user_el = html.select('.ProfileNav-item--userActions')[0]
-    user_id = user_el.select('.user-actions')[0]['data-user-id']
-
-    click.secho('User "{}" has ID {}.'.format(username, user_id), fg='green')
-
-    try:
-        position_el = html.select('.GridTimeline-items')[0]
-    except IndexError:
-        click.secho('Not able to get friends for {}'.format(username))
-        return users, graph
-
-    min_position = position_el['data-min-position']
-
-    click.secho('First page min position: {}'.format(min_position))
-
-    profile_els = html.select('.ProfileCard-content')
-    friends = 0
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        following = executor.submit(_get_relations, session, config,
+                                    max_follow, username, 'following')
+        followers = executor.submit(_get_relations, session, config,
+                                    max_follow, username, 'followers')
+        following = following.result()
+        followers = followers.result()
 
-    for profile_el in profile_els:
-        profile = profile_el.select('.user-actions')[0]
-        following_id = profile['data-user-id']
-        following_name = profile['data-screen-name']
+    return make_node(user_id, following, followers)
 
-        users[following_id] = following_name
-        graph[user_id].add(following_id)
-        friends += 1
 
-    # Fetch remaining pages of friends.
-    following_page_url = '{}/{}/following/users'.format(config.twitter_url, username)
+def _get_user_id(session, config, username):
+    ''' Scrape the user ID for `username` from their home page. '''
 
-    params = {
-        'include_available_features': '1',
-        'include_entities': '1',
-        'max_position': min_position,
-    }
-
-    while True:
-        click.echo('Getting {} with max position {}'
-                   .format(following_page_url, params['max_position']))
-        response = session.get(following_page_url, params=params)
-
-        if response.status_code != 200:
-            click.secho('Failed to fetch {} (error {})'
-                        .format(response.request.url, response.status_code))
-            break
+    home_url = '{}/{}'.format(config.twitter_url, username)
+    response = session.get(home_url)
 
-        body = response.json()
-        html = bs4.BeautifulSoup(body['items_html'], 'html.parser')
+    if response.status_code != 200:
+        raise click.ClickException('Not able to get home page for {}. ({})'
+                                   .format(username, response.status_code))
 
-        for profile_el in html.select('.user-actions'):
-            following_id = profile_el['data-user-id']
-            following_name = profile_el['data-screen-name']
+    html = LexborHTMLParser(response.text)
+    profile_el = html.css(HOME_USER_SELECTOR)[0]
+    return profile_el.attributes['data-user-id']
 
-            users[following_id] = following_name
-            graph[user_id].add(following_id)
-            friends += 1
 
-        if friends >= max_follow:
-            break
+def _get_relations(session, config, max_follow, username, relation):
+    '''
+    Fetch the users listed on one of a user's "following" or "followers"
+    pages, where `relation` is the name of the page.
 
-        if body['has_more_items']:
-            params['max_position'] = body['min_position']
-        else:
-            break
+    Returns a list of (ID, username) tuples.
+    '''
 
-    # Fetch first page of followers.
-    following_url = '{}/{}/followers'.format(config.twitter_url, username)
-    click.echo('Getting {}'.format(following_url))
-    response = session.get(following_url)
+    # Fetch first page.
+    url = '{}/{}/{}'.format(config.twitter_url, username, relation)
+    click.echo('Getting {}'.format(url))
+    response = session.get(url)
 
     if response.status_code != 200:
-        click.secho('Not able to fetch friends: ()'.format(response.status_code))
+        click.secho('Not able to fetch {}: {}'
+                    .format(relation, response.status_code))
 
-    html = bs4.BeautifulSoup(response.text, 'html.parser')
+    html = LexborHTMLParser(response.text)
 
     try:
-        position_el = html.select('.GridTimeline-items')[0]
+        position_el = html.css(TIMELINE_SELECTOR)[0]
     except IndexError:
-        click.secho('Not able to get followers for {}'.format(username))
-        return users, graph
+        click.secho('Not able to get {} for {}'.format(relation, username))
+        return []
 
-    min_position = position_el['data-min-position']
+    min_position = position_el.attributes['data-min-position']
 
     click.secho('First page min position: {}'.format(min_position))
 
-    profile_els = html.select('.ProfileCard-content')
-    followers = 0
+    profiles = [profile_el.css_first(PROFILE_CARD_USER_SELECTOR).attributes
+                for profile_el in html.css(PROFILE_CARD_SELECTOR)]
+    related = [(profile['data-user-id'], profile['data-screen-name'])
+               for profile in profiles]
 
-    for profile_el in profile_els:
-        profile = profile_el.select('.user-actions')[0]
-        follower_id = profile['data-user-id']
-        follower_name = profile['data-screen-name']
-
-        users[follower_id] = follower_name
-        graph[follower_id].add(user_id)
-        followers += 1
-
-    # Fetch remaining pages of followers.
-    following_page_url = '{}/{}/followers/users'.format(config.twitter_url, username)
+    # Fetch remaining pages.
+    page_url = '{}/users'.format(url)
 
     params = {
         'include_available_features': '1',
@@ -248,28 +207,26 @@ def _get_graph(session, config, max_follow, user_id, username):
         'max_position': min_position,
     }
 
-    while True:
+    # Stop paging as soon as the graph extraction ends, e.g. when interrupted.
+    while not config.stop.is_set():
         click.echo('Getting {} with max position {}'
-                   .format(following_page_url, params['max_position']))
-        response = session.get(following_page_url, params=params)
+                   .format(page_url, params['max_position']))
+        response = session.get(page_url, params=params)
 
         if response.status_code != 200:
             click.secho('Failed to fetch {} (error {})'
                         .format(response.request.url, response.status_code))
             break
 
-        body = response.json()
-        html = bs4.BeautifulSoup(body['items_html'], 'html.parser')
+        body = orjson.loads(response.content)
+        html = LexborHTMLParser(body['items_html'])
 
-        for profile_el in html.select('.user-actions'):
-            follower_id = profile_el['data-user-id']
-            follower_name = profile_el['data-screen-name']
+        profiles = [profile_el.attributes
+                    for profile_el in html.css(PAGE_USERS_SELECTOR)]
+        related.extend((profile['data-user-id'], profile['data-screen-name'])
+                       for profile in profiles)
 
-            users[follower_id] = follower_name
-            graph[follower_id].add(user_id)
-            followers += 1
-
-        if followers >= max_follow:
+        if len(related) >= max_follow:
             break
 
         if body['has_more_items']:
@@ -277,27 +234,34 @@ def _get_graph(session, config, max_follow, user_id, username):
         else:
             break
 
-    return users, graph
+    return related
 
 
 def _login_twitter(config):
     '''
     Log into a Twitter account and return a session.
 
-    If a session file exists in `config`, then that session will be deserialized
-    and returned instead of creating a new session.
+    If a session file exists in `config`, then the session cookies will be
+    loaded from it instead of logging in again. The file holds only the cookies,
+    as a JSON list of their `COOKIE_FIELDS`.
     '''
 
     if config.session is not None:
+        click.echo('Loading session from: {}'.format(config.session.name))
+
         try:
-            click.echo('Loading session from: {}'.format(config.session.name))
-            session = pickle.load(config.session)
-            return session
-        except:
+            cookies = orjson.loads(config.session.read())
+            session = http_session()
+
+            for cookie in cookies:
+                session.cookies.set(**cookie)
+        except (TypeError, ValueError):
             click.secho('No session found! Falling back to login.', fg='red')
+        else:
+            return session
 
     click.echo('Logging in to Twitter...')
-    session = requests.Session()
+    session = http_session()
     home_url = '{}/login'.format(config.twitter_url)
     home_response = session.get(home_url)
 
@@ -307,19 +271,18 @@ def _login_twitter(config):
             .format(home_response.status_code)
         )
 
-    page = bs4.BeautifulSoup(home_response.text, 'html.parser')
-    csrf_selector = 'input[name=authenticity_token]'
-    csrf_elements = page.select(csrf_selector)
+    page = LexborHTMLParser(home_response.text)
+    csrf_elements = page.css(CSRF_SELECTOR)
 
     if len(csrf_elements) == 0:
         raise click.ClickException(
             'Expected >=1 elements matching selector "{}", found 0 instead.'
-            .format(csrf_selector)
+            .format(CSRF_SELECTOR)
         )
 
     # There may be more than one CSRF element but they should all have the same
     # value, so we arbitrarily take the first one.
-    csrf_token = csrf_elements[0]['value']
+    csrf_token = csrf_elements[0].attributes['value']
     click.echo('Got CSRF token: {}'.format(csrf_token))
 
     login_url = '{}/sessions'.format(config.twitter_url)
@@ -353,10 +316,16 @@ def _login_twitter(config):
 
     if config.session is not None:
         click.echo('Writing session to file: {}'.format(config.session.name))
-        pickle.dump(session, config.session)
+        config.session.seek(0)
+        config.session.truncate()
+        cookies = [{field: getattr(cookie, field) for field in COOKIE_FIELDS}
+                   for cookie in session.cookies]
+        config.session.write(orjson.dumps(cookies))
 
     return session
 
 
 if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.INFO,
+                        stream=sys.stdout)
     cli()
@@ -1,17 +1,77 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import gzip
+from itertools import islice
+import logging
 import math
+from sys import intern
 
 import click
+import requests
+from requests.adapters import HTTPAdapter
+import requests_cache
 
 
-def get_graph(node_fn, seeds, max_depth):
+log = logging.getLogger(__name__)
+
+
+# Number of nodes to fetch concurrently within a hop. Fetching is I/O bound, so
+# this overlaps network latency across the frontier without exceeding the
+# concurrency that the APIs will tolerate.
+MAX_WORKERS = 16
+
+# Number of keep-alive connections to pool per host. This must be at least
+# MAX_WORKERS or concurrent requests will discard pooled connections.
+POOL_SIZE = 32
+
+# How long (in seconds) cached responses stay fresh.
+CACHE_EXPIRY = 24 * 60 * 60
+
+# Number of output lines to format per write. Batching keeps the number of
+# writes low without holding a whole large graph's output in memory at once.
+WRITE_BATCH = 65536
+
+# Gzip compression level for output files. The lowest level is fast and still
+# shrinks the TSV output several times over.
+GZIP_LEVEL = 1
+
+
+class OutputFile(click.File):
+    '''
+    A `click.File` for writing output, which is gzip-compressed if the file
+    name ends in ".gz".
+    '''
+
+    def __init__(self):
+        super().__init__('w', lazy=False)
+
+    def convert(self, value, param, ctx):
+        if not isinstance(value, str) or not value.endswith('.gz'):
+            return super().convert(value, param, ctx)
+
+        try:
+            file_ = gzip.open(value, 'wt', compresslevel=GZIP_LEVEL)
+        except OSError as e:
+            self.fail('Could not open file: {}: {}'.format(value, e.strerror),
+                      param, ctx)
+
+        if ctx is not None:
+            ctx.call_on_close(file_.close)
+
+        return file_
+
+
+def get_graph(node_fn, seeds, max_depth, max_workers=MAX_WORKERS,
+              visited=None, stop=None):
     '''
     Recursively extract a subgraph starting at the specified seeds and going up
     to `max_depth` hops .
 
     `node_fn` is a function that takes two arguments (a node ID and its name)
     and returns a `users` dict that maps IDs to usernames and a `graph` dict
-    that contains the induced subgraph of the specified node.
+    that contains the induced subgraph of the specified node. The sets in
+    `graph` are merged into the result without copying, so `node_fn` must
+    return new sets on every call.
 
     `max_depth` is a multiple of 0.5. If `max_depth` is a whole number (e.g. 1),
     then the graph will be extracted to that many hops, but edges between nodes
@@ -20,85 +80,278 @@ def get_graph(node_fn, seeds, max_depth):
 
     `seeds` is a dictionary (or iterable of 2-tuples) mapping seed node IDs to
     names.
+
+    Nodes within a hop are fetched concurrently by up to `max_workers` threads,
+    so `node_fn` must be safe to call from multiple threads.
+
+    `visited` is an optional set-like container (anything supporting `in` and
+    `add()`) of node IDs that have already been fetched, so that a node isn't
+    fetched again across crawls that share it. Nodes in it are not fetched,
+    apart from the seeds, and each node that is fetched is added to it. It is
+    checked in addition to the users found by this crawl, which are all kept.
+
+    `stop` is an optional `threading.Event` that is set when the crawl ends or
+    is interrupted. A `node_fn` that waits (e.g. for a rate limit to reset)
+    should wait on it, so that it gives up rather than keeping the process
+    alive after the crawl is over.
+    '''
+
+    return get_graphs(node_fn, [seeds], max_depth, max_workers, visited,
+                      stop)[0]
+
+
+def get_graphs(node_fn, seed_batches, max_depth, max_workers=MAX_WORKERS,
+               visited=None, stop=None):
+    '''
+    Extract a separate subgraph for each dict of seeds in `seed_batches`, as
+    `get_graph()` does for one, and return a list of `(users, graph)` tuples in
+    the same order. The other arguments are the same as for `get_graph()`, and
+    `visited` is shared by all of the crawls.
+
+    Each hop's nodes from every crawl are fetched together by the same
+    `max_workers` threads, so one crawl's slowest nodes don't leave the pool
+    idle.
     '''
 
-    users = dict(seeds)
-    graph = defaultdict(set)
-    next_hop = dict(seeds)
+    crawls = [_Crawl(seeds) for seeds in seed_batches]
     max_depth_int = math.ceil(max_depth)
-    include_last_hop_nodes = max_depth_int == max_depth
-    half_depth = max_depth_int != max_depth
+
+    # How the last hop is added depends only on `max_depth`, so choose once.
+    if max_depth_int == max_depth:
+        finish_last_hop = _finish_whole_depth
+    else:
+        finish_last_hop = _finish_half_depth
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    last_hop = True
 
     try:
         for depth in range(1, max_depth_int + 1):
-            print('Getting graph at depth={}'.format(depth))
-            hop_users = dict()
-            hop_graph = defaultdict(set)
+            log.info('Getting graph at depth=%d', depth)
+            last_hop = depth == max_depth_int
+            futures = dict()
+
+            for crawl in crawls:
+                crawl.hop_users = dict()
+
+                # Only the last hop needs its edges kept apart for filtering, so
+                # other hops merge theirs straight into the graph.
+                crawl.hop_graph = dict() if last_hop else crawl.graph
+
+                # Get induced graphs for each node in the next hop concurrently,
+                # tagged with the crawl that they belong to.
+                for node_id, node_name in crawl.next_hop.items():
+                    future = executor.submit(node_fn, node_id, node_name)
+                    futures[future] = (crawl, node_id, node_name)
+
+            # Combine the induced graphs as they arrive.
+            for future in as_completed(futures):
+                crawl, node_id, node_name = futures[future]
 
-            # Get induced graphs for each node in the next hop and combine them.
-            for node_id, node_name in next_hop.items():
                 try:
-                    node_users, node_graph = node_fn(node_id, node_name)
-                except:
-                    print('Failed fetching graph node id={}, name={}'
-                          .format(node_id, node_name))
+                    node_users, node_graph = future.result()
+                except Exception:
+                    # Only show the traceback when debugging, so that failures
+                    # take one line each.
+                    log.warning('Failed fetching graph node id=%s, name=%s',
+                                node_id, node_name,
+                                exc_info=log.isEnabledFor(logging.DEBUG))
                     continue
-                hop_users.update(node_users)
-                merge_graphs(node_graph, hop_graph)
-
-            if depth < max_depth_int:
-                # This is not the last hop: add all edges.
-                merge_graphs(hop_graph, graph)
-            else:
-                if half_depth:
-                    # This is the last hop and we should include edges only
-                    # between nodes already in the graph or current hop.
-                    known_nodes = set(users.keys()) | set(next_hop.keys())
-
-                    for follower, follows in hop_graph.items():
-                        if follower in known_nodes:
-                            graph[follower] |= (follows & known_nodes)
+                if visited is not None:
+                    visited.add(node_id)
+                crawl.hop_users.update(node_users)
+                merge_graphs(node_graph, crawl.hop_graph)
+
+            for crawl in crawls:
+                if last_hop:
+                    finish_last_hop(crawl.users, crawl.graph, crawl.next_hop,
+                                    crawl.hop_users, crawl.hop_graph)
                 else:
-                    # This is the last hop and we should include edges that
-                    # start or end at a node already in the graph (but not in
-                    # the current hop).
-                    known_nodes = set(users.keys())
+                    crawl.next_hop = _next_hop(crawl.users, crawl.hop_users,
+                                               visited)
+                    crawl.users.update(crawl.hop_users)
 
-                    for follower, follows in hop_graph.items():
-                        if follower in known_nodes:
-                            graph[follower] |= follows
-                        else:
-                            graph[follower] |= (follows & known_nodes)
+    except KeyboardInterrupt:
+        log.warning('Received signal... cleaning up')
 
-            next_hop = {k:hop_users[k] for k in hop_users if k not in users}
+        # Edges from an interrupted hop other than the last one are already in
+        # the graph, so keep their users too.
+        if not last_hop:
+            for crawl in crawls:
+                crawl.users.update(crawl.hop_users)
+    finally:
+        if stop is not None:
+            stop.set()
 
-            # Add users from this hop unless its the last hop in a "half" depth.
-            if depth < max_depth_int or include_last_hop_nodes:
-                users.update(hop_users)
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    except KeyboardInterrupt:
-        print('Received signal... cleaning up')
+    return [(crawl.users, crawl.graph) for crawl in crawls]
+
+
+class _Crawl(object):
+    ''' The state of one crawl in `get_graphs()`. '''
+
+    def __init__(self, seeds):
+        self.users = dict(seeds)
+        self.graph = defaultdict(set)
+        self.next_hop = dict(self.users)
+        self.hop_users = dict()
+        self.hop_graph = None
+
+
+def _next_hop(users, hop_users, visited):
+    '''
+    Return the users found in a hop that aren't in `users` (or `visited`, if
+    given) yet, which are the nodes to fetch in the next hop.
+    '''
+
+    # If none of them are in the graph yet, reuse the dict as is.
+    if users.keys().isdisjoint(hop_users):
+        next_hop = hop_users
+    else:
+        next_hop = {k: v for k, v in hop_users.items() if k not in users}
+
+    if visited is not None:
+        next_hop = {k: v for k, v in next_hop.items() if k not in visited}
+
+    return next_hop
+
+
+def _finish_whole_depth(users, graph, frontier, hop_users, hop_graph):
+    '''
+    Add the last hop of a whole-number depth to `users` and `graph`.
+
+    All of the hop's users are added, but only edges that start or end at a
+    node that was already in the graph (not one first found in this hop).
+    '''
+
+    known_nodes = set(users)
+
+    for follower, follows in hop_graph.items():
+        if follower in known_nodes:
+            graph[follower] |= follows
+        else:
+            # Don't add empty entries for the (many) new followers with no
+            # edges into the graph.
+            follows = follows & known_nodes
+
+            if follows:
+                graph[follower] |= follows
+
+    users.update(hop_users)
+
+
+def _finish_half_depth(users, graph, frontier, hop_users, hop_graph):
+    '''
+    Add the last hop of a "half" depth to `graph`.
+
+    No new users are added, only edges between nodes already in the graph or
+    in `frontier`, the nodes that were fetched in this hop.
+    '''
+
+    known_nodes = users.keys() | frontier.keys()
+
+    # Intersect the followers with the known nodes up front, rather than
+    # testing every follower in Python.
+    for follower in hop_graph.keys() & known_nodes:
+        graph[follower] |= (hop_graph[follower] & known_nodes)
+
+
+def http_session(cache_path=None):
+    '''
+    Create a `requests.Session` that reuses connections.
+
+    Reusing a session avoids a new TCP and TLS handshake for every request. If
+    `cache_path` is given, successful responses are also cached in an SQLite
+    database at that path, so re-running an extraction doesn't fetch them
+    again.
+    '''
+
+    if cache_path is None:
+        session = requests.Session()
+    else:
+        session = requests_cache.CachedSession(cache_path,
+                                               expire_after=CACHE_EXPIRY,
+                                               allowable_codes=[200])
+
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    return session
+
+
+def make_node(user_id, following, followers):
+    '''
+    Build the `users` and `graph` dicts that a `get_graph()` node function
+    returns for `user_id`.
+
+    `following` and `followers` are lists of (ID, name) tuples for the users
+    that `user_id` follows and is followed by, respectively.
+    '''
+
+    # Intern the IDs: the same user turns up in many responses, each of which
+    # decodes to a new string, so this keeps one copy of each ID across the
+    # whole graph and lets set lookups match IDs by identity.
+    user_id = intern(user_id)
+    following = [(intern(id_), name) for id_, name in following]
+    followers = [(intern(id_), name) for id_, name in followers]
+
+    users = dict(following)
+    users.update(followers)
+
+    # Build the adjacency with bulk updates rather than one add() per edge.
+    # Followers go first so that if a user follows themselves, their own entry
+    # is extended below rather than replaced.
+    graph = defaultdict(set, ((follower_id, {user_id})
+                              for follower_id, _ in followers))
+    graph[user_id].update(following_id for following_id, _ in following)
 
     return users, graph
 
 
 def merge_graphs(source, dest):
-    ''' Merge graph `source` into `dest`. '''
+    '''
+    Merge graph `source` into `dest`.
+
+    Where `dest` has no entry for a follower, the set from `source` is moved
+    into `dest` instead of being copied, so `source` must not be used after
+    merging.
+    '''
+
+    dest_get = dest.get
 
     for follower, follows in source.items():
-        dest[follower] |= follows
+        existing = dest_get(follower)
+
+        if existing is None:
+            dest[follower] = follows
+        else:
+            existing |= follows
 
 
 def write_graph(graph, file_):
     ''' Write graph data to open file handle. '''
 
-    for user, follows in graph.items():
-        for follow in follows:
-            file_.write('{}\t{}\n'.format(user, follow))
+    _write_lines((f'{user}\t{follow}\n'
+                  for user, follows in graph.items()
+                  for follow in follows), file_)
 
 
 def write_users(users, file_):
     ''' Write user ID and username to open file handle. '''
 
-    for user_id, username in users.items():
-        file_.write('{}\t{}\n'.format(user_id, username))
+    _write_lines((f'{user_id}\t{username}\n'
+                  for user_id, username in users.items()), file_)
+
+
+def _write_lines(lines, file_):
+    ''' Write lines to open file handle in batches of `WRITE_BATCH`. '''
+
+    lines = iter(lines)
+
+    while True:
+        batch = ''.join(islice(lines, WRITE_BATCH))
+
+        if not batch:
+            break
+
+        file_.write(batch)